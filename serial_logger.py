@@ -12,10 +12,10 @@
 #   this newer version will be installed and started;
 # - status output to a LED (red=error, green=ok, briefly blue=data frame received and stored);
 # - textual messages to an optional LCD-screen (16x2) which can be switched on/off by the script (controlled via LCD_PIN)
-# - Writes log information to stdout
+# - Writes log information to stdout (set LOG_LEVEL to logging.DEBUG to log every data frame)
 # 
 # One packet is about 100 chars @ (9600 Baud = 960 bytes/sec) => packet time is about 0.1 sec
-# Script needs to be run as root to be able to mount usb drives and access serial ports
+# Script needs to be run as root to be able to mount usb drives and access serial ports (and to set the latency timer of FTDI adaptors)
 #
 # Tested with a Raspberry Pi model B+ v1.2 running Debian Bookworm, Python 3.11. 
 #
@@ -27,7 +27,8 @@
 # - create mount point for USB, for example: mkdir /media/logdata
 # - create temporary folder to store files when no usb drive is present: mkdir /root/serial_logger
 # - apt install pip (to be able to install additional Python modules)
-# - pip install pyserial psutil (needed to use the serial port and get the mac-address, execute as root because the script will run as root)
+# - pip install pyserial (needed to use the serial port, execute as root because the script will run as root)
+# - optional: pip install psutil (fallback to get the mac-address if it can not be read from /sys/class/net/eth0/address)
 # - optional: raspi-config: switch on ssh, set timezone, hostname, overclock, .. 
 # - optional: copy lines in rc.local to /etc to auto start the script when starting the Pi
 # - optional: connect power button and power led
@@ -40,19 +41,64 @@ import signal
 import serial
 import sys
 import os, subprocess, shutil
-import psutil
+import selectors
+import re
+import mmap
+import threading, queue
+import logging, logging.handlers
+try:
+    import psutil                   # optional, only used as fallback to get the mac address
+except ImportError:
+    psutil = None
 from RPLCD.i2c import CharLCD       # see https://rplcd.readthedocs.io/en/stable/
 
 # "constants":
 LED_R = 17                  # pin of red led
 LED_G = 27                  # pin of green led
 LED_B = 22                  # pin of blue led
-PACKET_TIMEOUT = 0.1        # timeout to wait before concluding a new packet was received. Also used for a short delay in the main loop.
+ALL_LEDS = [LED_R, LED_G, LED_B]    # pins of all leds, in the order used to set them
+PACKET_TIMEOUT = 0.1        # timeout to wait before concluding a new packet was received.
+RECONNECT_DELAY = 0.5       # delay in seconds after a failed attempt to open the serial port, doubled after every next failure.
+RECONNECT_MAX_DELAY = 5.0   # max delay in seconds between two attempts to open the serial port.
+LOOP_TIMEOUT = 0.25         # max time in seconds the main loop waits for serial data before checking if it has to stop.
+HOUSEKEEPING_PERIOD = 0.5   # time in seconds between two updates of the LED and LCD by the housekeeping thread.
+HOUSEKEEPING_NICE = 10      # niceness (absolute value) of the housekeeping thread, so it never delays receiving serial data.
+USB_CHECK_PERIOD = 1.0      # time in seconds between two checks for a (re)inserted or removed USB drive by the housekeeping thread.
+PACKET_LINES = 5            # number of lines in one data frame.
+INTER_BYTE_TIMEOUT = 0.01   # max time in seconds between two bytes of a running read from the serial port.
+LATENCY_TIMER = 1           # latency timer in msec of FTDI USB-serial adaptors (Linux default is 16), lower means small frames arrive sooner.
 SCRIPT_VERSION = "3.0"      # version of this script, used for determining if an updated version of the script is available.
 SCRIPTID = "'serial_logger.py' v"+SCRIPT_VERSION+" by fokke@bronsema.net" # identification of this script, shown at init.
 TMP_FOLDER = "/tmp/serial_logger" # temp folder of this program.  
+MAX_UPDATE_SIZE = 1000000   # max size in bytes of an update of this script, larger files are ignored.
 LED_PERIOD = 500            # duration of blue receive-flash of LED in msec.
+STATUS_SERIAL_ERROR = 1     # bitflag in the script status (see Status_LED.update): serial port is not ok.
+STATUS_OUTPUT_ERROR = 2     # bitflag in the script status: output folder is not mounted (i.e.: USB stick was removed from system).
 LCD_PIN = 25                # GPIO pin at which the LCD power is connected.
+LCD_COLS = 16               # number of characters on one line of the LCD.
+FLUSH_AFTER = 10            # max number of data frames after which the open logfile is flushed to disk (limits data loss on sudden USB removal).
+                            # the logfile is also flushed as soon as no serial data is coming in, see receive loop.
+LOG_BUFFER_SIZE = 8192      # size in bytes of the write buffer of the open logfile.
+BATCH_LINES = 8             # number of csv lines collected in memory before they are written to the logfile in one go.
+BATCH_MAX_AGE = 2.0         # max time in seconds a csv line is kept in memory before it is written to the logfile.
+MOUNT_CHECK_PERIOD = 2.0    # time in seconds during which the result of a mount check is reused.
+LOG_LEVEL = logging.INFO    # level of the log output to stdout, logging.DEBUG also logs every received frame.
+LOG_CAPACITY = 64           # max number of log records collected before they are written to stdout. Warnings and errors are written at once,
+                            # the rest when the housekeeping thread flushes them (every HOUSEKEEPING_PERIOD while it runs) or at exit.
+
+# layout of a data frame: date, time and type number on one line each, then "<weight> <unit>" and "<weight> <unit> <result>".
+# Values are stripped of surrounding whitespace, extra values at the end of the weight lines are ignored.
+# The last line does not need a line ending (see SerialAdaptor.receive), so a truncated last line is accepted as well.
+PACKET_RE = re.compile(
+    rb'[ \t]*([^\r\n]*?)[ \t]*\r?\n'
+    rb'[ \t]*([^\r\n]*?)[ \t]*\r?\n'
+    rb'[ \t]*([^\r\n]*?)[ \t]*\r?\n'
+    rb'[ \t]*(\S+)[ \t]+(\S+)[^\n]*\n'
+    rb'[ \t]*(\S+)[ \t]+(\S+)[ \t]+(\S+)[^\n]*\n?\Z')
+VERSION_RE = re.compile(rb'^SCRIPT_VERSION\s*=\s*"([^"]+)"', re.M)   # finds the version in (an update of) this script
+PACKET_FIELDS = ("date", "time", "typenr", "weight1", "unit1", "weight2", "unit2", "result")   # names of the groups in PACKET_RE
+
+log = logging.getLogger("serial_logger")
 
 # global vars:
 run = True                  # if true, keep on running. Script will stop when this becomes false.
@@ -60,6 +106,8 @@ serial_adaptor = None       # object with serial adaptor functions
 writer = None               # object to deal with output file, USB stick
 status_led = None           # object to deal with the status LED
 lcd = None                  # LCD display
+stop_event = threading.Event()  # set when the housekeeping thread has to stop
+log_buffer = None           # handler collecting the log records before they are written to stdout
 
 
 class SerialAdaptor:
@@ -69,18 +117,41 @@ class SerialAdaptor:
     serialport = ""             # name of serial port (read from command line)
     ser_status = False          # current status of serial port (true = present, false = removed)
     lcd = None
+    rx_buffer = None            # received bytes that do not form a complete line yet
+    rx_lines = None             # complete lines received so far for the current data frame
+    rx_time = 0                 # time (monotonic) at which the last bytes were received
+    selector = None             # selector used to wait for data on the serial port
+    ser_fd = None               # file descriptor of the serial port registered with the selector
+    reconnect_delay = RECONNECT_DELAY   # delay after the next failed attempt to open the serial port
 
 
     def __init__(self, lcd, serialport):
     # constructor    
         self.serialport = serialport
         self.lcd = lcd
+        self.rx_buffer = bytearray()
+        self.rx_lines = []
+        self.selector = selectors.DefaultSelector()
         
 
     def __del__(self):
     # destructor    
-        self.ser.close()        
-        print (f"Closed serial port {self.serialport}")
+        self.close_serial()        
+        log.info ("Closed serial port %s", self.serialport)
+
+
+    def close_serial (self):
+    # unregisters the serial port from the selector and closes it
+
+        if self.ser_fd != None:
+            try:
+                self.selector.unregister(self.ser_fd)
+            except (KeyError, ValueError):
+                pass
+            self.ser_fd = None
+
+        if self.ser != None:
+            self.ser.close()
         
 
     def connect_to_serial (self):
@@ -94,80 +165,133 @@ class SerialAdaptor:
             #        parity=serial.PARITY_NONE,
             #        stopbits=serial.STOPBITS_ONE,
             #        bytesize=serial.EIGHTBITS,
-                    timeout=PACKET_TIMEOUT     
+                    timeout=PACKET_TIMEOUT,
+                    inter_byte_timeout=INTER_BYTE_TIMEOUT
             )  
-            print (f"Opened serial port {self.serialport}")
+            self.set_latency_timer()
+            self.ser_fd = self.ser.fileno()
+            self.selector.register(self.ser_fd, selectors.EVENT_READ)   # wake up the main loop as soon as data arrives
+            log.info ("Opened serial port %s", self.serialport)
             self.ser_status = True        
+            self.reconnect_delay = RECONNECT_DELAY
             self.lcd.write_lines ("Serial connected")
-        except:
-            print (f"Opening serial port {self.serialport} failed")
-            time.sleep(0.5)   # a short delay before trying it again
+        except (serial.SerialException, OSError, ValueError) as ex:
+            log.warning ("Opening serial port %s failed: %s", self.serialport, ex)
+            time.sleep(self.reconnect_delay)   # a delay before trying it again, longer after every failure
+            self.reconnect_delay = min(self.reconnect_delay*2, RECONNECT_MAX_DELAY)
             self.ser_status = False
             self.lcd.write_lines ("Connect serial")
               
         return self.ser_status
     
 
+    def set_latency_timer (self):
+    # sets the latency timer of the USB-serial adaptor to LATENCY_TIMER (needs root)
+    # only FTDI adaptors have this setting, for other adaptors (or without root) nothing happens
+
+        path = f"/sys/bus/usb-serial/devices/{os.path.basename(self.serialport)}/latency_timer"
+        try:
+            with open(path, "w") as file:
+                file.write(str(LATENCY_TIMER))
+            log.info ("Set latency timer of %s to %d ms", self.serialport, LATENCY_TIMER)
+        except OSError:
+            pass
+
+
     def parse_msg (self, msg):
     # parses the received messages from serial
-    # in: msg, the raw received message in the form of a list of lines of bytes (as read in by serial.readlines)
+    # in: msg, the raw received message in the form of a list of lines of bytes (including the line endings)
     # out: returns a dict containing the parsed information or "None" when an illegal msg was received
     
-        print ("Received raw:", msg)
+        log.debug ("Received raw: %s", msg)
 
-        if len(msg) != 5:
-            print (f"Illegal message of {len(msg)} lines (should be 5)")
+        if len(msg) != PACKET_LINES:
+            log.warning ("Illegal message of %d lines (should be %d)", len(msg), PACKET_LINES)
             return None
     
-        # get the values from the lines:
+        # get the values from the lines in one pass:
         try:        
-            parsed = {}
-            parsed["date"] = msg[0].decode().strip()
-            parsed["time"] = msg[1].decode().strip()
-            parsed["typenr"] = msg[2].decode().strip()
-    
-            temp = msg[3].decode().strip().split(' ')
-            temp = list(filter(None, temp)) # remove empty values from list
-            parsed["weight1"] = temp[0]
-            parsed["unit1"] = temp[1]
-
-            temp = msg[4].decode().strip().split(' ')
-            temp = list(filter(None, temp))
-            parsed["weight2"] = temp[0]
-            parsed["unit2"] = temp[1]
-            parsed["result"] = temp[2]
-
-            print ("Parsed into dict: ", parsed)
+            match = PACKET_RE.match(b"".join(msg))
+            if match == None:
+                log.warning ("Skipped this malformed message.")
+                return None
+
+            parsed = dict(zip(PACKET_FIELDS, (value.decode() for value in match.groups())))
+
+            log.debug ("Parsed into dict: %s", parsed)
             return parsed
     
-        except:
-            print (f"Skipped this malformed message.")        
+        except UnicodeDecodeError:
+            log.warning ("Skipped this malformed message.")
             return None
         
 
-    def receive (self):       
+    def is_idle (self):
+    # returns true if no (incomplete) data frame is being received at the moment
+        return len(self.rx_lines) == 0 and len(self.rx_buffer) == 0
+
+
+    def receive (self, timeout):       
     # sees if there is a data frame available and returns it in a csv-format
     # return None if no frame was available
+    # waits for max timeout seconds until data arrives, reads everything that is waiting in one go and splits it into lines,
+    # a frame is complete when PACKET_LINES lines are received. After PACKET_TIMEOUT of silence, whatever was received is handed
+    # over to parse_msg as a frame, including a last line without line ending (like serial.readlines did).
 
         recv_data = None
         
         try:
-            if (self.ser != None):
+            if (self.ser != None and self.ser.is_open):
             # Ser is initialised
-                recv_data = self.ser.readlines()   # read multiple lines with a timeout 
-                if len(recv_data) == 0:
-                    recv_data = None
+                if len(self.rx_lines) >= PACKET_LINES:
+                # a complete frame was already received by an earlier read, only pick up what is waiting
+                    timeout = 0
+                elif len(self.rx_lines) > 0 or len(self.rx_buffer) > 0:
+                # an incomplete frame is pending, wake up in time to drop it
+                    timeout = min(timeout, PACKET_TIMEOUT)
+
+                chunk = b""
+                if len(self.selector.select(timeout)) > 0:
+                # data available, read it (raises an exception if the port is gone)
+                    chunk = self.ser.read(max(self.ser.in_waiting, 1))
+                    while self.ser.in_waiting > 0:
+                        chunk += self.ser.read(self.ser.in_waiting)
+
+                now = time.monotonic()
+                if len(chunk) > 0:
+                # data received, split it into complete lines and keep the trailing partial line in the buffer
+                    self.rx_time = now
+                    self.rx_buffer += chunk
+                    lines = self.rx_buffer.split(b'\n')
+                    self.rx_buffer = bytearray(lines.pop())
+                    self.rx_lines += [bytes(line)+b'\n' for line in lines]
+
+                if len(self.rx_lines) >= PACKET_LINES:
+                # a complete frame is received
+                    recv_data = self.rx_lines[:PACKET_LINES]
+                    self.rx_lines = self.rx_lines[PACKET_LINES:]
+                elif (len(self.rx_lines) > 0 or len(self.rx_buffer) > 0) and now - self.rx_time > PACKET_TIMEOUT:
+                # incomplete frame followed by silence, hand it over and resync on the next frame. parse_msg rejects it if lines are
+                # missing, but a frame of which only the end of the last line is missing can not be told apart from a frame that is
+                # not terminated by a line ending, so it is accepted (as it was with serial.readlines)
+                    recv_data = self.rx_lines
+                    if len(self.rx_buffer) > 0:
+                        recv_data.append(bytes(self.rx_buffer))
+                    self.rx_lines = []
+                    self.rx_buffer = bytearray()
             else:
                 self.connect_to_serial ()   
-        except:
+        except (serial.SerialException, OSError) as ex:
         # error in serial port, reconnect
-            print ("Error reading from serial.");
-            self.ser.close()
+            log.warning ("Error reading from serial: %s", ex)
+            self.ser_status = False
+            self.rx_lines = []
+            self.rx_buffer = bytearray()
+            self.close_serial()
             self.connect_to_serial ()
    
         if recv_data != None and len(recv_data) > 0:
         # msg received, try to parse it       
-            print () # empty line
             recv_data = self.parse_msg (recv_data)            
 
         return recv_data            
@@ -180,20 +304,95 @@ class Writer:
     filename = None         # name of the output file, determined by script 
     current_output = None   # current output folder (either a temporary file or a file on "folder")
     lcd = None
+    logfile = None          # open (buffered) handle of the current output file, None if no file is open
+    logfile_path = None     # full path of the file opened as logfile
+    unflushed_frames = 0    # number of frames written to logfile since the last flush
+    pending_lines = None    # csv lines not yet written to logfile (see BATCH_LINES)
+    pending_time = 0        # time (monotonic) at which the oldest line in pending_lines was added
+    mounted = False         # cached result of is_mounted
+    mounted_time = None     # time (monotonic) of the last real mount check, None forces a new check
+    mac_prefix = ""         # mac address of eth0 without ':' followed by '_', used as start of the filename
+    lock = None             # lock for the file and mount state, used by both the receive loop and the housekeeping thread
 
 
     def __init__ (self, lcd, folder):    
     # constructor
         self.folder = folder
         self.lcd = lcd
+        self.lock = threading.RLock()
+        self.logfile = None
+        self.pending_lines = []
+        self.mac_prefix = self.get_mac_prefix()
         self.umount_usb_drive()   # umount drive, could be mounted as RO
 
 
     def __del__ (self):
     # destructor 
+        self.close_logfile ()
         self.umount_usb_drive ()       
+
+
+    def close_logfile (self):
+    # flushes and closes the open logfile (if any)
+
+        if self.logfile != None:
+            try:
+                self.write_pending_lines()
+                self.logfile.close()
+                log.info ("Closed file %s", self.logfile_path)
+            except Exception as ex:
+                log.warning ("Closing file %s failed, exception: %s", self.logfile_path, ex)
+            self.logfile = None
+            self.logfile_path = None
+            self.unflushed_frames = 0
+            self.pending_lines.clear()
+
+
+    def write_pending_lines (self):
+    # writes the lines collected in memory to the open logfile in one go
+
+        if len(self.pending_lines) > 0:
+            self.logfile.write("".join(self.pending_lines))
+            self.pending_lines.clear()
+
+
+    def flush_logfile (self):
+    # writes the buffered data of the open logfile (if any) to disk
+
+        with self.lock:   # called from the receive loop
+            if self.logfile != None and self.unflushed_frames > 0:
+                try:
+                    self.write_pending_lines()
+                    self.logfile.flush()
+                except Exception as ex:
+                    log.warning ("Unable to write to file %s, data is lost. Exception: %s", self.logfile_path, ex)
+                    self.close_logfile ()
+                else:
+                    self.unflushed_frames = 0
         
 
+    def get_mac_prefix (self):
+    # returns the mac address of eth0 without ':' and followed by '_' to distinguish between Pi's in the logfile names
+    # returns an empty string if the mac address can not be determined
+
+        try:
+            with open("/sys/class/net/eth0/address") as file:
+                return file.read().strip().replace(":","")+"_"
+        except OSError:
+            pass
+
+        if psutil != None:
+            try:
+                for interface in psutil.net_if_addrs()['eth0']:
+                    if interface.family == psutil.AF_LINK:  # mac address
+                        return interface.address.replace (":","")+"_"       # remove ':' from mac address
+            except KeyError:
+                pass
+
+        log.warning ("Unable to determine the mac address of eth0, it is left out of the filenames")
+        return ""
+
+
     def get_filename (self, data):
     # returns the filename excluding the path, based on the timestamp in the data and the mac address of this Pi
 
@@ -202,22 +401,15 @@ class Writer:
         if (self.filename == None and data != None):
         # filename not determined yet and data is available -> determine file name based on mac address, date and time:
             try:
-                self.filename = ""
-
-                # get the mac_address to distinguish between Pi's in the logfile names:
-                nic_eth0 = psutil.net_if_addrs()['eth0']
-                for interface in nic_eth0:
-                    if interface.family == 17:  # mac address
-                        self.filename = interface.address.replace (":","")+"_"       # remove ':' from mac address
+                self.filename = self.mac_prefix
                                                
                 temp = data["date"].split('/')
                 self.filename += temp[2]+temp[1]+temp[0]
                 self.filename += "-"+data["time"].replace(':','_')+".csv"
             
-                print (f"New filename: {self.filename}")
-            except:
-                print ("Error determining new filename, input:")
-                print (data)
+                log.info ("New filename: %s", self.filename)
+            except (KeyError, IndexError, AttributeError):
+                log.warning ("Error determining new filename, input: %s", data)
                 self.filename = None
 
         return self.filename
@@ -226,9 +418,10 @@ class Writer:
     def get_usb_drives (self):
     # returns a list of USB drives connected to the system
     # thanks to: https://stackoverflow.com/questions/2384290/better-way-to-script-usb-device-mount-in-linux    
-       
-        partitionsFile = open("/proc/partitions")
-        lines = partitionsFile.readlines()[2:] #Skips the header lines
+    # only called by mount_if_needed, which the housekeeping thread runs once every USB_CHECK_PERIOD
+
+        with open("/proc/partitions") as partitionsFile:
+            lines = partitionsFile.readlines()[2:] #Skips the header lines
         drives = []
 
         for line in lines:
@@ -244,11 +437,25 @@ class Writer:
         return drives                    
 
 
+    def mountinfo_has (self, path):
+    # returns true if path is a mount point according to the kernel (/proc/self/mountinfo), without running mount
+
+        needle = b" "+path.encode()+b" "
+        with open("/proc/self/mountinfo", "rb") as mountinfo:
+            return any(needle in line for line in mountinfo)
+
+
     def is_mounted (self):
-    # returns true if folder is mounted (in other words: if it is mentioned in the output of mount)
+    # returns true if folder is mounted (in other words: if it is mentioned as mount point in /proc/self/mountinfo)
+    # the result is cached for MOUNT_CHECK_PERIOD seconds, (un)mounting by this script resets the cache
+
+        now = time.monotonic()
+        if self.mounted_time != None and now - self.mounted_time < MOUNT_CHECK_PERIOD:
+            return self.mounted
 
-        out = str(subprocess.run("mount", capture_output = True).stdout)
-        return self.folder in out
+        self.mounted = self.mountinfo_has(self.folder)
+        self.mounted_time = now
+        return self.mounted
 
 
     def check_for_update (self, location):
@@ -260,55 +467,74 @@ class Writer:
     
         myname = os.path.basename(sys.argv[0])
     
-        print (f"Checking for an update at {location}/{myname}")
+        log.info ("Checking for an update at %s/%s", location, myname)
     
         try:
-            with open(location+"/"+myname, 'r') as file:
-                data = file.read()
-        except:
-            print ("No update available, continuing with the script")
+            with open(location+"/"+myname, 'rb') as file:
+                size = os.fstat(file.fileno()).st_size
+                if size == 0 or size > MAX_UPDATE_SIZE:
+                    log.warning ("Ignoring file of %d bytes, continuing with the script", size)
+                    return
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    match = VERSION_RE.search(data)
+        except OSError:
+            log.info ("No update available, continuing with the script")
             return
     
-        data = data.split ("SCRIPT_VERSION")[1].lstrip()  
-    
-        if data[0] == '=' : 
+        if match != None: 
         # version is available, isolate it:
-            new_version = data.splitlines()[0].split('"')[1] 
-            print (f"Found version number in mounted file: {new_version}")
+            new_version = match.group(1).decode(errors="replace")
+            log.info ("Found version number in mounted file: %s", new_version)
 
-            if (new_version > SCRIPT_VERSION): 
+            if version_tuple(new_version) == ():
+                log.warning ("Unable to parse version number %s (should be numbers separated by '.'), ignoring this file", new_version)
+            elif (version_tuple(new_version) > version_tuple(SCRIPT_VERSION)): 
                 mypath=os.path.abspath(os.path.dirname(__file__))
-                print (f"New version is higher than current version ({SCRIPT_VERSION}), installing new version to {mypath}/{myname}")
+                log.info ("New version is higher than current version (%s), installing new version to %s/%s", SCRIPT_VERSION, mypath, myname)
                 try:
                     shutil.copyfile (location+"/"+myname, mypath+"/"+myname)
-                except:
-                    print("Copy failed, continuing")
+                except OSError:
+                    log.warning ("Copy failed, continuing")
                 else:    
-                    print ("New version copied, starting it and self-terminating")
+                    log.info ("New version copied, starting it and self-terminating")
                     self.lcd.write_lines ("Updated script", f"From {SCRIPT_VERSION} to {new_version}", 1)
+                    with self.lock:   # held until execl, so the receive loop can not start a new logfile that would be lost
+                        self.close_logfile ()   # destructors are not called by execl, write the buffered data now
                     
-                    try:
-                        os.execl (sys.executable, *([sys.executable]+sys.argv)) # call same script with same cmdline parameters
-                        print ("This should never be shown")
-                    except:
-                        print ("Starting next process failed")
+                        try:
+                            # this runs in the (low priority) housekeeping thread and the new process would inherit its niceness,
+                            # so first give this thread the priority of the main thread (on Linux the thread id of the main thread is the pid):
+                            os.setpriority (os.PRIO_PROCESS, threading.get_native_id(), os.getpriority(os.PRIO_PROCESS, os.getpid()))
+                        except OSError:
+                            log.warning ("Unable to reset the priority, the new version will run with a lower priority")
+
+                        for handler in logging.getLogger().handlers:
+                            handler.flush()     # same for the buffered log output
+
+                        try:
+                            os.execl (sys.executable, *([sys.executable]+sys.argv)) # call same script with same cmdline parameters
+                            log.error ("This should never be shown")
+                        except OSError:
+                            log.warning ("Starting next process failed")
             else:
-                print (f"Already at this version or better, keeping current version {SCRIPT_VERSION}")
+                log.info ("Already at this version or better, keeping current version %s", SCRIPT_VERSION)
+        else:
+            log.info ("No version number found in mounted file, continuing with the script")
 
 
     def mount_usb_drive (self, drive, location):
     # tries to mount the USB drive at the specified location
     
-        print (f"Trying to mount {drive} at location {location}.")
+        log.info ("Trying to mount %s at location %s.", drive, location)
         
         out = subprocess.run(["mount", drive, location], capture_output = True)
+        self.mounted_time = None   # mount state changed (or not), force a new check
         if out.returncode == 0:
-            print ("Mount OK")
+            log.info ("Mount OK")
             self.check_for_update (location)
             return True
         else:
-            print (f"Mount ERROR, returned: ")
-            print (out)
+            log.warning ("Mount ERROR, returned: %s", out)
             return False
 
 
@@ -316,113 +542,143 @@ class Writer:
     # umounts the drive, returns true if it actually was unmounted    
 # tbd: try .. except?
         if self.is_mounted ():
+            with self.lock:
+                self.close_logfile ()   # the logfile could be on the drive, close it before unmounting
             out = subprocess.run(["umount", self.folder], capture_output = True)
-            if out:
-                print (f"Unmounted {self.folder}")
+            self.mounted_time = None   # mount state changed (or not), force a new check
+            if out.returncode == 0:
+                log.info ("Unmounted %s", self.folder)
                 return True
             else:    
-                print (f"Unmount of {self.folder} failed, returned:")
-                print (out)
+                log.warning ("Unmount of %s failed, returned: %s", self.folder, out)
     
         return False
 
 
-    def mount_if_needed (self):
+    def mount_if_needed (self, mounted):
     # mounts the USB drive if needed and possible    
+    # in: mounted, the result of is_mounted as already determined by the caller
+    # out: returns true if the output is written to the mounted folder (false if it is written to TMP_FOLDER)
+
+        # the lock is only held to switch the output, mounting and moving files is done without it so the receive loop can keep on writing
 
         # first see if any USB drives are connected:
         drives = self.get_usb_drives()
         if len (drives) == 0: 
         # no drive inserted, write output to temp and unmount the drive (which could still be mounted)   
-            self.current_output = TMP_FOLDER
-            if self.umount_usb_drive ():
-            # the drive was still mounted, reset the file name    
-                self.filename = None
+            with self.lock:
+                self.current_output = TMP_FOLDER
+                if mounted:
+                # the drive was still mounted, close the logfile on it and reset the file name    
+                    self.close_logfile ()
+                    self.filename = None
+            if mounted:
+                self.umount_usb_drive ()
         else:
         # a USB drive is present but possibly not mounted
-            if self.is_mounted ():
+            if mounted:
             # it is mounted, write to it    
-                self.current_output = self.folder
+                with self.lock:
+                    self.current_output = self.folder
             else:
             # it is not mounted, but it is possible to mount
 
-                # mount the usb drive:                
+                # mount the usb drive (in the mean time the output is still written to temp):                
                 out = self.mount_usb_drive (drives[0], self.folder)            
                 if out:
-                    # move the logfile(s) in temp to the usb drive:
-                    for file in os.listdir (TMP_FOLDER):  
-                        #if file.isfile ():
-                        if file.endswith('.csv'):
-                        # this is a .csv file, move it    
-                            out = subprocess.run(["mv", TMP_FOLDER+"/"+file, self.folder], capture_output = True)    
-                            if out:
-                                print (f"Moved file {file} from {TMP_FOLDER} to {self.folder}")
-                            else:    
-                                print (f"Moving file {file} to {self.folder} failed. Result:")
-                                print (out)
-                        else:
-                        # only copy the other files, give them a new name 
-                            if self.filename == None:
-                                new_name = self.folder+"/"+file
+                # mount succeeded, close the logfile in temp (it is about to be moved) and continue in a new file on the drive    
+                    with self.lock:
+                        self.close_logfile ()
+                        old_filename = self.filename
+                        self.filename = None                
+                        self.current_output = self.folder
+
+                    # move the logfile(s) in temp to the usb drive, nothing is written to temp anymore:
+                    with os.scandir (TMP_FOLDER) as entries:
+                        for entry in entries:  
+                            if not entry.is_file ():
+                                continue
+
+                            file = entry.name
+                            if file.endswith('.csv'):
+                            # this is a .csv file, move it (the temp folder is on another filesystem, so this is a copy + delete)
+                                try:
+                                    shutil.move (entry.path, self.folder+"/"+file)
+                                    log.info ("Moved file %s from %s to %s", file, TMP_FOLDER, self.folder)
+                                except OSError as ex:
+                                    log.warning ("Moving file %s to %s failed. Exception: %s", file, self.folder, ex)
                             else:
-                                new_name = self.folder+"/"+self.filename+"_"+file
+                            # only copy the other files, give them a new name 
+                                if old_filename == None:
+                                    new_name = self.folder+"/"+file
+                                else:
+                                    new_name = self.folder+"/"+old_filename+"_"+file
                                 
-                            out = subprocess.run(["cp", TMP_FOLDER+"/"+file, new_name], capture_output = True)    
-                            if out:
-                                print (f"Copied file {file} from {TMP_FOLDER} to {new_name}")
-                            else:    
-                                print (f"Copying file {file} to {new_name} failed. Result:")
-                                print (out)
-
-                # mount succeeded, a new file is needed    
-                    self.filename = None                
-                    self.current_output = self.folder
+                                try:
+                                    shutil.copyfile (entry.path, new_name)
+                                    log.info ("Copied file %s from %s to %s", file, TMP_FOLDER, new_name)
+                                except OSError as ex:
+                                    log.warning ("Copying file %s to %s failed. Exception: %s", file, new_name, ex)
                 else:
                 # mount failed :-(
-                    self.current_output = TMP_FOLDER
+                    with self.lock:
+                        self.current_output = TMP_FOLDER
+
+        return self.current_output == self.folder
  
 
     def write_data (self, data):
     # writes the data to the indicated file, deals with (not) present USB stick
 
-        temp = ""
-        output_to = "" 
-        i = 0
-        global folder, filename
-        
-        # now either the USB drive is ready or we write to the temp location.   
-        filename = self.get_filename(data)
+        with self.lock:   # called from the receive loop, the housekeeping thread could (un)mount in the mean time
+            # now either the USB drive is ready or we write to the temp location.   
+            self.get_filename(data)
     
-        # create output line:
-        for field in data.values():
-            if (i>0):
-                temp += ';'
-            temp += field
-            i += 1
+            # create output line:
+            line = ";".join(csv_field(value) for value in data.values())
     
-        # write it to the file:
-        try:
-            logfile = open(self.current_output+"/"+self.filename, "a") 
-            logfile.write(temp+"\n")
-            logfile.close()
-            print (f"Wrote to {self.current_output}/{self.filename}: '{temp}'")
-        except Exception as ex:
-            print (f"Unable to write to file {self.current_output}/{self.filename}, data is lost. Exception:")
-            print (ex)
+            # write it to the file, (re)open the file only when the output path changed:
+            try:
+                path = self.current_output+"/"+self.filename
+                if self.logfile == None or self.logfile_path != path:
+                    self.close_logfile ()
+                    self.logfile = open(path, "a", buffering=LOG_BUFFER_SIZE) 
+                    self.logfile_path = path
+                    log.info ("Opened file %s", path)
+
+                # collect the lines in memory and write them in batches:
+                if len(self.pending_lines) == 0:
+                    self.pending_time = time.monotonic()
+                self.pending_lines.append(line+"\n")
+                self.unflushed_frames += 1
+                if len(self.pending_lines) >= BATCH_LINES or time.monotonic() - self.pending_time > BATCH_MAX_AGE:
+                    self.write_pending_lines()
+
+                if self.unflushed_frames >= FLUSH_AFTER:
+                # data keeps coming in, flush anyway to limit data loss when the USB drive is removed
+                    self.flush_logfile()
+                log.debug ("Wrote to %s: '%s'", path, line)
+            except Exception as ex:
+                log.warning ("Unable to write to file %s/%s, data is lost. Exception: %s", self.current_output, self.filename, ex)
+                self.close_logfile ()
 
 
 class Status_LED:
     led_timer = 0               # timer for the blue receive-flash
     time_on = 0
-    current_status = 255        # current script status (see get_status)    
-    start_millis = None
+    current_status = 255        # script status currently shown (see update), 255 if unknown
+    start_ns = None             # monotonic time in nsec at creation of this object
+    led_states = None           # output states last written to ALL_LEDS, None if unknown
+    lock = None                 # lock for the LED state, used by both the receive loop and the housekeeping thread
 
     def __init__(self):
     # constructor; init the output pins and show a test sequence
 
+        self.lock = threading.Lock()
+
         # set GPIO pins of the LEDs
-        GPIO.setup ([LED_R, LED_G, LED_B], GPIO.OUT)
-        print ("GPIO setup ok, showing test sequence")
+        GPIO.setup (ALL_LEDS, GPIO.OUT)
+        log.info ("GPIO setup ok, showing test sequence")
     
         # show a test sequence on the LED at startup:
         self.setLed ([LED_R])
@@ -432,45 +688,58 @@ class Status_LED:
         self.setLed ([LED_B])
         time.sleep(1)
         
-        self.start_millis = int(time.time()*1000.0)
-        print ("Test sequence complete")
+        self.start_ns = time.monotonic_ns()
+        log.info ("Test sequence complete")
 
         
     def __del__(self):
     # destructor, switch off the leds
         self.setLed([])   
-        print ("Switched off LEDs")
+        log.info ("Switched off LEDs")
 
 
     def get_millis(self):
-    # returns the amount of msecs passed since creation of this object    
-        return int(time.time()*1000.0) - self.start_millis
+    # returns the amount of msecs passed since creation of this object (monotonic, not affected by changes of the clock)
+        return (time.monotonic_ns() - self.start_ns) // 1000000
 
     
     def flash_led (self, pin, time):
     # switches on the LED@pin for time milliseconds
-        self.led_timer = self.get_millis() + time
-        self.setLed([pin])
-        #print ("Flash start, timer = ",self.led_timer, "millis =",self.get_millis())
+        with self.lock:   # called from the receive loop
+            self.led_timer = self.get_millis() + time
+            self.setLed([pin])
+            #log.debug ("Flash start, timer = %d, millis = %d", self.led_timer, self.get_millis())
         
 
-    def update(self, status):
-    # updates the LED if needed
+    def update(self, serial_ok, mounted):
+    # updates the LED if needed, based on the already known state of the serial port and the output folder:
+    # green if both are ok, red if one or both are not ok (script status is a combination of STATUS_SERIAL_ERROR and STATUS_OUTPUT_ERROR)
         
-        if self.led_timer > 0 and self.get_millis() - self.led_timer > 0:
-        # flash led is switched on and shall be switched off because of the timeout of led_timer
-            self.led_timer = 0
-            self.current_status = 255
-            #print ("Flash end at millis = ", self.get_millis())
+        with self.lock:   # called from the housekeeping thread
+            if self.led_timer > 0:
+                if self.get_millis() - self.led_timer <= 0:
+                # flash led is still switched on, nothing to do
+                    return
+
+                # flash led is switched on and shall be switched off because of the timeout of led_timer
+                self.led_timer = 0
+                self.current_status = 255
+                #log.debug ("Flash end at millis = %d", self.get_millis())
             
-        if self.led_timer == 0:            
-        # flash led is switched off, show regular status    
+            # flash led is switched off, show regular status    
+            status = 0
+            if not serial_ok:
+                status |= STATUS_SERIAL_ERROR
+            if not mounted:
+                status |= STATUS_OUTPUT_ERROR
+
             if status != self.current_status:
             # an update is needed    
                 if status == 0:
                     self.setLed([LED_G])
                 else:
                     self.setLed([LED_R])
+                self.current_status = status
 
 
     def setLed (self, ledpins):
@@ -478,22 +747,27 @@ class Status_LED:
     # ledpins is a list of pins to set low (=on)
     # use a list of ledpins, e.g. [LED_R], [LED_G], [LED_B], [LED_R, LED_G, LED_B], [] etc
 
-        # first all LEDs off:
-        GPIO.output ([LED_R, LED_B, LED_G], GPIO.HIGH)
-    
-        # then the correct LEDs on again:
-        for pin in ledpins:
-            GPIO.output (pin, GPIO.LOW)
+        # set all LEDs in one call, only if something changes:
+        states = [GPIO.LOW if pin in ledpins else GPIO.HIGH for pin in ALL_LEDS]
+        if states != self.led_states:
+            GPIO.output (ALL_LEDS, states)
+            self.led_states = states
                         
 
 class LCD_logger:
 # a class for the LCD display
 
     lcd = None
+    last_lines = None           # lines currently shown on the screen, None if unknown (screen will be cleared)
+    lock = None                 # lock for the screen, used by both the receive loop and the housekeeping thread
+    pending = None              # queue of lines to show, filled by the receive loop and shown by the housekeeping thread
 
     def __init__(self):
     # constructor, show startup message
 
+        self.lock = threading.RLock()
+        self.pending = queue.Queue()
+
         # set power to the LCD screen, wait a short period for the screen to stabilise:
         GPIO.setup (LCD_PIN, GPIO.OUT)
         GPIO.output (LCD_PIN, GPIO.HIGH)
@@ -501,15 +775,15 @@ class LCD_logger:
 
         try:
             # initialise the screen:
-            self.lcd = CharLCD(i2c_expander='PCF8574', address=0x27, port=3, cols=16, rows=2)
-        except:  
-            print ("Geen LCD scherm gevonden")
+            self.lcd = CharLCD(i2c_expander='PCF8574', address=0x27, port=3, cols=LCD_COLS, rows=2)
+        except (OSError, ImportError):  
+            log.info ("Geen LCD scherm gevonden")
             self.lcd = None
         else:            
             self.lcd.clear()
             self.lcd.write_string("Initialising\r\n")
             self.lcd.write_string("Version: "+SCRIPT_VERSION)   
-            print ("LCD setup OK")
+            log.info ("LCD setup OK")
 
 
     def __del__(self):
@@ -517,28 +791,69 @@ class LCD_logger:
         
         if self.lcd != None:
             self.lcd.clear()
+            self.last_lines = None
             self.write_lines("Script stopped", "", 1)       
 
         GPIO.output (LCD_PIN, GPIO.LOW)
         
         
     def write_data (self, data):
-    # shows the measurement data on the lcd
-        if self.lcd != None:
-            self.lcd.clear()
-            self.lcd.write_string(data["time"]+"\r\n")
-            self.lcd.write_string(data["weight1"]+" kg")
+    # queues the measurement data to be shown on the lcd by update (does not block on the i2c bus)
+        self.pending.put((data["time"], data["weight1"]+" kg"))
+
+
+    def update (self):
+    # shows the most recent lines queued by write_data (if any)
+        lines = None
+        try:
+            while True:
+                lines = self.pending.get_nowait()
+        except queue.Empty:
+            pass
+
+        if lines != None:
+            self.write_lines(*lines)
 
 
     def write_lines (self, line1, line2="", wait=0):
     # writes the lines to the lcd, waits (blocks) for wait sec    
-        if self.lcd != None:
-            self.lcd.clear()
-            self.lcd.write_string(line1)
-            self.lcd.cursor_pos = (1, 0)
-            self.lcd.write_string(line2)
-            if wait > 0:
-                time.sleep (wait)
+    # only lines that differ from what is on the screen are rewritten (padded with spaces to overwrite the old text)
+        with self.lock:   # called from both the receive loop and the housekeeping thread
+            if self.lcd != None:
+                try:
+                    if self.last_lines == None:
+                    # screen content unknown, start with a clean screen
+                        self.lcd.clear()
+                        self.last_lines = ("", "")
+
+                    for row, line in enumerate((line1, line2)):
+                        if line != self.last_lines[row]:
+                            self.lcd.cursor_pos = (row, 0)
+                            self.lcd.write_string(line.ljust(LCD_COLS))
+                    self.last_lines = (line1, line2)
+                except OSError as ex:
+                # i2c bus error, the screen content is unknown now: it is cleared and rewritten at the next call
+                    log.warning ("Error writing to the LCD: %s", ex)
+                    self.last_lines = None
+
+                if wait > 0:
+                    time.sleep (wait)
+
+
+def csv_field (value):
+# returns the value as a field of a ';'-separated csv line: as is, or between quotes (with '"' doubled) if it contains ';' or '"'
+    if ';' in value or '"' in value:
+        return '"'+value.replace('"', '""')+'"'
+    return value
+
+
+def version_tuple (version):
+# returns the version string (e.g. "3.10") as a tuple of numbers (e.g. (3, 10)) so versions can be compared
+# returns an empty tuple if the version is not made up of numbers
+    try:
+        return tuple(int(part) for part in version.split('.'))
+    except ValueError:
+        return ()
 
 
 def init ():
@@ -546,18 +861,24 @@ def init ():
 # sets the serial port to read from and the folder to write to
 # (serial port is initialised in the main loop)
 
-    global serial_adaptor, writer, status_led, lcd
+    global serial_adaptor, writer, status_led, lcd, log_buffer
 
-    print (f"Starting {SCRIPTID}")
+    # log to stdout, collect the records and write them in bursts:
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    log_buffer = logging.handlers.MemoryHandler(LOG_CAPACITY, flushLevel=logging.WARNING, target=output)
+    logging.basicConfig(level=LOG_LEVEL, handlers=[log_buffer])
+
+    log.info ("Starting %s", SCRIPTID)
     os.system("echo default-on>/sys/class/leds/pwr_led/trigger")   # tell the kernel to keep the power led on
 
     # parse command line parameters:
     if len(sys.argv) == 3:
         serialport = sys.argv[1]
         folder = sys.argv[2].rstrip("/") 
-        print (f"Command line parameters parsed OK (serial={serialport}, output folder={folder})")
+        log.info ("Command line parameters parsed OK (serial=%s, output folder=%s)", serialport, folder)
     else:
-        print (f"Usage: {sys.argv[0]} <serial port> <output path>")
+        log.error ("Usage: %s <serial port> <output path>", sys.argv[0])
         exit(1)
 
     GPIO.setwarnings(False) 
@@ -572,20 +893,20 @@ def init ():
     # create TMP_FOLDER if it does not exist yet:
     if not os.path.exists(TMP_FOLDER):
         os.makedirs (TMP_FOLDER)
-        print (f"Created temp folder {TMP_FOLDER}")
+        log.info ("Created temp folder %s", TMP_FOLDER)
     
     # same for output folder:
     if not os.path.exists(folder):
         os.makedirs (folder)
-        print (f"Created output folder {folder}")
+        log.info ("Created output folder %s", folder)
 
     # set the signal handlers:
     signal.signal(signal.SIGINT, cleanup_function)
     signal.signal(signal.SIGTERM, cleanup_function)
     signal.signal(signal.SIGHUP, cleanup_function)
-    print ("Signal handlers setup ok")
+    log.info ("Signal handlers setup ok")
 
-    print ("Init is finished")
+    log.info ("Init is finished")
      
 
 def cleanup_function(signalnr, frame):
@@ -595,47 +916,71 @@ def cleanup_function(signalnr, frame):
 
     try:
         os.system("echo heartbeat>/sys/class/leds/pwr_led/trigger")   # tell the kernel to start blinking the power LED
-    except:
-        print ("Heartbeat failed")
+    except OSError:
+        log.warning ("Heartbeat failed")
         
     run = False    
-    print (f"Received signal {signalnr}, terminating script")
+    log.info ("Received signal %d, terminating script", signalnr)
 
 
-def get_status (serial_adaptor, writer):
-# returns the current status of the script:
-# - 0 if the serial port is opened and the output file is available (all OK)
-# - 1 if the serial port is not ok
-# - 2 if the serial port is ok but the output folder is not (i.e.: USB stick was removed from system)
-# - 3 if both the serial port and the output are not ok
-    
-    retval = 0
-    if not serial_adaptor.ser_status:
-        retval += 1
+def housekeeping ():
+# runs in a separate thread with a lower priority: checks for USB drives and updates the LED and LCD
+# stops when stop_event is set
+
+    try:
+        os.setpriority (os.PRIO_PROCESS, threading.get_native_id(), HOUSEKEEPING_NICE)   # on Linux this sets the priority of this thread only
+    except OSError:
+        log.warning ("Unable to lower the priority of the housekeeping thread")
+
+    next_usb_check = 0   # time (monotonic) of the next check for a mounted usb drive
+
+    while not stop_event.is_set():
+        try:
+            mounted = writer.is_mounted()   # checked once per pass, used for both mounting and the status LED
+
+            if time.monotonic() >= next_usb_check:
+            # regularly check for a mounted usb drive
+                mounted = writer.mount_if_needed(mounted)
+                next_usb_check = time.monotonic() + USB_CHECK_PERIOD
+
+            lcd.update()
+
+            # update status led if needed:
+            status_led.update(serial_adaptor.ser_status, mounted)
+        except Exception:
+        # never let this thread die, without it the USB drive and the LED are not handled anymore
+            log.exception ("Error in housekeeping, trying again in the next pass")
+
+        # write the collected log records, so the log output is never far behind:
+        log_buffer.flush()
+
+        stop_event.wait (HOUSEKEEPING_PERIOD)
 
-    if not writer.is_mounted(): 
-        retval += 2
-        
-    return retval
-            
 
 # main program:
 init()
 
+# determine the output folder before the first data comes in, then leave the USB drive, LED and LCD to the housekeeping thread:
+writer.mount_if_needed(writer.is_mounted())
+housekeeping_thread = threading.Thread(target=housekeeping, name="housekeeping", daemon=True)
+housekeeping_thread.start()
+
+# receive loop:
 while run:
-    recv_data = serial_adaptor.receive()  # read data from serial, will block for PACKET_TIMEOUT seconds
-    writer.mount_if_needed()  # regularly check for a mounted usb drive
-    
+    recv_data = serial_adaptor.receive(LOOP_TIMEOUT)  # read data from serial, returns as soon as data arrived or after LOOP_TIMEOUT seconds
+
     if recv_data != None:
     # msg parsed OK, write it to disk and show blue light
         writer.write_data (recv_data)
         lcd.write_data (recv_data)
         status_led.flash_led (LED_B, LED_PERIOD)
-     
-    # update status led if needed:
-    status_led.update(get_status(serial_adaptor, writer))
+    elif serial_adaptor.is_idle():
+    # no data is coming in, a good moment to write the buffered data to disk
+        writer.flush_logfile()
 
 # terminate the program when "run" becomes False:     
+stop_event.set()
+housekeeping_thread.join()
 del status_led
 del writer
 del serial_adaptor